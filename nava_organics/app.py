@@ -1,8 +1,21 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, make_response, abort
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import click
+import gzip
+import hashlib
+import json
 import os
 
+try:
+    import orjson
+except ImportError:  # optional, the API falls back to the stdlib json module
+    orjson = None
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'dev-secret-key-change-me'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///nava_organics.db'
@@ -69,12 +82,30 @@ class OrderItem(db.Model):
     line_total = db.Column(db.Integer, nullable=False)
 
 
+class ReceiptBlob(db.Model):
+    # content-addressed: digest is the sha256 of the uncompressed html
+    digest = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)  # gzip-compressed html
+
+
+class Receipt(db.Model):
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), primary_key=True)
+    digest = db.Column(db.String(64), db.ForeignKey('receipt_blob.digest'), nullable=False)
+    printable_digest = db.Column(db.String(64), db.ForeignKey('receipt_blob.digest'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
 class Favourite(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'))
 
 
+# Create tables added since the database was initialized (e.g. receipts); existing data is kept
+with app.app_context():
+    db.create_all()
+
+
 # Utility functions
 
 def get_cart():
@@ -89,6 +120,88 @@ def calculate_cart_total(cart):
     return sum(item['line_total'] for item in cart)
 
 
+def make_cart_line(product, quantity, variant=''):
+    if product.category == 'serum' and variant == '30ml':
+        unit_price = product.secondary_price or product.base_price
+        variant_label = product.secondary_volume or '30 ml'
+    else:
+        unit_price = product.base_price
+        variant_label = product.base_volume
+
+    return {
+        'product_id': product.id,
+        'product_name': product.name,
+        'variant_label': variant_label,
+        'unit_price': unit_price,
+        'quantity': quantity,
+        'line_total': unit_price * quantity,
+    }
+
+
+# Receipt store – receipts are rendered once when payment succeeds and kept
+# gzip-compressed, so viewing one never reloads the order items.
+
+def receipt_snapshot(order):
+    order_data = dict(
+        id=order.id,
+        customer_name=order.customer_name,
+        customer_email=order.customer_email,
+        customer_phone=order.customer_phone,
+        customer_address=order.customer_address,
+        total_amount=order.total_amount,
+        payment_status=order.payment_status,
+        card_type=order.card_type,
+        account_last4=(order.account_number or '')[-4:],
+        created_at=order.created_at,
+    )
+    items = [
+        dict(
+            product_name=i.product_name,
+            variant_label=i.variant_label,
+            unit_price=i.unit_price,
+            quantity=i.quantity,
+            line_total=i.line_total,
+        )
+        for i in order.items
+    ]
+    return order_data, items
+
+
+def compress_receipt(html):
+    raw = html.encode('utf-8')
+    # mtime=0 keeps the compressed bytes identical for identical html
+    return hashlib.sha256(raw).hexdigest(), gzip.compress(raw, mtime=0)
+
+
+def build_receipt(order_data, items):
+    # rendered straight through the jinja env (no context processors), so it
+    # needs no request context and can run in worker processes
+    body = app.jinja_env.get_template('receipt_body.html').render(order=order_data, items=items)
+    printable = app.jinja_env.get_template('receipt_print.html').render(order=order_data, items=items)
+    return compress_receipt(body), compress_receipt(printable)
+
+
+def build_receipt_snapshot(snapshot):
+    return build_receipt(*snapshot)
+
+
+def save_receipt(order_id, built):
+    for digest, data in built:
+        if not ReceiptBlob.query.get(digest):
+            db.session.add(ReceiptBlob(digest=digest, data=data))
+    (digest, _), (printable_digest, _) = built
+    receipt = Receipt.query.get(order_id) or Receipt(order_id=order_id)
+    receipt.digest = digest
+    receipt.printable_digest = printable_digest
+    db.session.add(receipt)
+    return receipt
+
+
+def load_receipt_html(digest):
+    blob = ReceiptBlob.query.get(digest)
+    return gzip.decompress(blob.data).decode('utf-8') if blob else None
+
+
 # Auth helpers
 from functools import wraps
 
@@ -104,6 +217,11 @@ def login_required(f):
     return decorated
 
 
+def can_view_order(order):
+    user = session.get('user')
+    return bool(user) and (user.get('is_admin') or order.user_id == user['id'])
+
+
 # Seed initial data
 @app.cli.command('init-db')
 def init_db_command():
@@ -160,6 +278,36 @@ def init_db_command():
     print('Initialized the database and seeded data.')
 
 
+@app.cli.command('regenerate-receipts')
+@click.option('--workers', type=int, help='Number of processes rendering receipts (default: CPU count).')
+def regenerate_receipts_command(workers):
+    """Re-render stored receipts for all paid orders, e.g. after a template change."""
+    orders = (
+        Order.query.options(selectinload(Order.items))
+        .filter_by(payment_status='Payment Successful')
+        .all()
+    )
+    snapshots = [receipt_snapshot(o) for o in orders]
+
+    # rendering is pure python, so spread it over processes rather than threads;
+    # snapshots are plain dicts and pickle cheaply
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        built = list(pool.map(build_receipt_snapshot, snapshots, chunksize=16))
+
+    for order, receipt_files in zip(orders, built):
+        save_receipt(order.id, receipt_files)
+    db.session.flush()
+
+    # drop blobs no longer referenced by any receipt; NULLs would make NOT IN match nothing
+    live = select(Receipt.digest).union(
+        select(Receipt.printable_digest).where(Receipt.printable_digest.isnot(None))
+    )
+    ReceiptBlob.query.filter(ReceiptBlob.digest.notin_(live)).delete(synchronize_session=False)
+
+    db.session.commit()
+    print(f'Regenerated {len(built)} receipts.')
+
+
 # Context processor
 @app.context_processor
 def inject_globals():
@@ -222,24 +370,8 @@ def add_to_cart():
 
     product = Product.query.get_or_404(product_id)
 
-    if product.category == 'serum' and variant == '30ml':
-        unit_price = product.secondary_price or product.base_price
-        variant_label = product.secondary_volume or '30 ml'
-    else:
-        unit_price = product.base_price
-        variant_label = product.base_volume
-
-    line_total = unit_price * quantity
-
     cart_items = get_cart()
-    cart_items.append({
-        'product_id': product.id,
-        'product_name': product.name,
-        'variant_label': variant_label,
-        'unit_price': unit_price,
-        'quantity': quantity,
-        'line_total': line_total,
-    })
+    cart_items.append(make_cart_line(product, quantity, variant))
     save_cart(cart_items)
     flash('Added to cart.')
 
@@ -360,6 +492,11 @@ def payment(order_id):
     order = Order.query.get_or_404(order_id)
 
     if request.method == 'POST':
+        if order.payment_status == 'Payment Successful':
+            # the stored receipt is final; do not take payment twice
+            flash('This order has already been paid.')
+            return redirect(url_for('receipt', order_id=order.id))
+
         account_number = request.form.get('account_number', '').strip()
         card_type = request.form.get('card_type', '').strip()
         pin = request.form.get('pin', '').strip()
@@ -377,7 +514,13 @@ def payment(order_id):
         order.card_type = card_type or 'Card'
         # mark payment as successful immediately for both user and admin views
         order.payment_status = 'Payment Successful'
-        db.session.commit()
+        # line items and totals are final now, so render the receipt once
+        try:
+            save_receipt(order.id, build_receipt(*receipt_snapshot(order)))
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent payment for this order stored the receipt first
+            db.session.rollback()
 
         return redirect(url_for('receipt', order_id=order.id))
 
@@ -389,12 +532,72 @@ def payment(order_id):
 @login_required
 def receipt(order_id):
     order = Order.query.get_or_404(order_id)
+    if not can_view_order(order):
+        flash('You can only view receipts for your own orders.')
+        return redirect(url_for('my_orders'))
     steps = ['Order Placed', 'Order Confirmed', 'Order Dispatched', 'Order Reached']
     try:
         current_index = steps.index(order.status)
     except ValueError:
         current_index = 0
-    return render_template('receipt.html', order=order, steps=steps, current_index=current_index)
+
+    stored = Receipt.query.get(order.id)
+    if stored is None and order.payment_status == 'Payment Successful':
+        # paid before receipts were stored; store it now
+        try:
+            stored = save_receipt(order.id, build_receipt(*receipt_snapshot(order)))
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent view stored it first
+            db.session.rollback()
+            stored = Receipt.query.get(order.id)
+    receipt_html = load_receipt_html(stored.digest) if stored else None
+    if receipt_html is None:
+        # payment still pending, nothing final to store yet
+        receipt_html = render_template('receipt_body.html', order=order, items=order.items)
+
+    # only the status tracker around the stored receipt is rendered per view
+    response = make_response(render_template(
+        'receipt.html',
+        order=order,
+        receipt_html=receipt_html,
+        has_printable=bool(stored and stored.printable_digest),
+        steps=steps,
+        current_index=current_index,
+    ))
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route('/receipt/<int:order_id>/print')
+@login_required
+def receipt_print(order_id):
+    order = Order.query.get_or_404(order_id)
+    if not can_view_order(order):
+        flash('You can only view receipts for your own orders.')
+        return redirect(url_for('my_orders'))
+    stored = Receipt.query.get_or_404(order.id)
+    if not stored.printable_digest:
+        abort(404)
+
+    gzipped = bool(request.accept_encodings['gzip'])
+    etag = f'{stored.printable_digest}-gz' if gzipped else stored.printable_digest
+    if etag in request.if_none_match:
+        # the digest is the etag, so repeat views never load the blob
+        response = make_response('', 304)
+    else:
+        blob = ReceiptBlob.query.get_or_404(stored.printable_digest)
+        response = make_response(blob.data if gzipped else gzip.decompress(blob.data))
+        response.mimetype = 'text/html'
+        if gzipped:
+            response.headers['Content-Encoding'] = 'gzip'
+        if request.args.get('download') == '1':
+            response.headers['Content-Disposition'] = f'attachment; filename=nava-organics-receipt-{order_id}.html'
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 @app.route('/order/<int:order_id>')
@@ -675,6 +878,216 @@ def my_orders():
     return render_template('my_orders.html', orders=orders)
 
 
+# JSON API (v1) – for mobile/headless clients
+
+API_PAGE_SIZE = 20
+API_MAX_PAGE_SIZE = 100
+PRODUCT_FIELDS = (
+    'id', 'name', 'category', 'description', 'image_url',
+    'base_price', 'secondary_price', 'base_volume', 'secondary_volume',
+)
+ORDER_FIELDS = (
+    'id', 'customer_name', 'total_amount', 'status', 'payment_status', 'created_at',
+)
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@app.errorhandler(ApiError)
+def handle_api_error(error):
+    return api_response({'error': error.message}, status=error.status)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dump_json(payload):
+    if orjson is not None:
+        return orjson.dumps(payload, default=_json_default)
+    return json.dumps(payload, default=_json_default, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def api_response(payload, status=200):
+    response = make_response(dump_json(payload), status)
+    response.mimetype = 'application/json'
+    if request.method == 'GET' and status == 200:
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.add_etag()
+        return response.make_conditional(request)
+    return response
+
+
+def api_login_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not session.get('user'):
+            raise ApiError('Login required.', status=401)
+        return f(*args, **kwargs)
+
+    return decorated
+
+
+def parse_int_list(raw, name):
+    try:
+        return [int(v) for v in raw.split(',') if v.strip()]
+    except ValueError:
+        raise ApiError(f'{name} must be a comma-separated list of integers.')
+
+
+def parse_fields(allowed):
+    raw = request.args.get('fields', '').strip()
+    if not raw:
+        return list(allowed)
+    fields = [f.strip() for f in raw.split(',') if f.strip()]
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise ApiError(f"Unknown fields: {', '.join(unknown)}.")
+    # id is always returned, cursors are built from it
+    return ['id'] + [f for f in fields if f != 'id']
+
+
+def parse_page_args():
+    try:
+        limit = int(request.args.get('limit', API_PAGE_SIZE))
+        cursor = request.args.get('cursor')
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        raise ApiError('limit and cursor must be integers.')
+    return max(1, min(limit, API_MAX_PAGE_SIZE)), cursor
+
+
+def select_rows(model, fields):
+    # only the requested columns are loaded
+    return model.query.with_entities(*[getattr(model, f) for f in fields])
+
+
+def paginate(query, key, limit, cursor, descending=False):
+    if cursor is not None:
+        query = query.filter(key < cursor if descending else key > cursor)
+    query = query.order_by(key.desc() if descending else key)
+    rows = [row._asdict() for row in query.limit(limit + 1)]
+    next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+    return {'data': rows[:limit], 'next_cursor': next_cursor}
+
+
+def op_int(op, key, position, default=None):
+    value = op.get(key, default)
+    # JSON numbers only: no floats or numeric strings, and bool is not an int here
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ApiError(f'ops[{position}]: {key} must be an integer.')
+    return value
+
+
+def cart_payload(cart_items):
+    return {'items': cart_items, 'count': len(cart_items), 'total': calculate_cart_total(cart_items)}
+
+
+@app.route('/api/v1/products')
+def api_products():
+    fields = parse_fields(PRODUCT_FIELDS)
+    query = select_rows(Product, fields)
+
+    ids = request.args.get('ids')
+    if ids is not None:
+        ids = parse_int_list(ids, 'ids')
+        if len(ids) > API_MAX_PAGE_SIZE:
+            raise ApiError(f'At most {API_MAX_PAGE_SIZE} ids can be requested at once.')
+        found = {row.id: row._asdict() for row in query.filter(Product.id.in_(ids))}
+        return api_response({
+            'data': [found[i] for i in ids if i in found],
+            'missing': [i for i in ids if i not in found],
+        })
+
+    category = request.args.get('category', 'all')
+    search = request.args.get('q', '').strip()
+    if category != 'all':
+        query = query.filter(Product.category == category)
+    if search:
+        query = query.filter(Product.name.ilike(f"%{search}%"))
+
+    limit, cursor = parse_page_args()
+    return api_response(paginate(query, Product.id, limit, cursor))
+
+
+@app.route('/api/v1/orders')
+@api_login_required
+def api_orders():
+    user = session.get('user')
+    fields = parse_fields(ORDER_FIELDS)
+    query = select_rows(Order, fields).filter(Order.user_id == user['id'])
+    limit, cursor = parse_page_args()
+    # newest first, like the My Orders page
+    return api_response(paginate(query, Order.id, limit, cursor, descending=True))
+
+
+@app.route('/api/v1/cart', methods=['GET', 'POST'])
+@api_login_required
+def api_cart():
+    """Return the cart, or on POST apply a batch of cart ops and return the new totals."""
+    if request.method == 'GET':
+        return api_response(cart_payload(get_cart()))
+
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        raise ApiError('Request body must be a JSON object.')
+    ops = data.get('ops')
+    if not isinstance(ops, list) or not ops:
+        raise ApiError('ops must be a non-empty list.')
+
+    user = session.get('user')
+    adds = {position: op for position, op in enumerate(ops) if isinstance(op, dict) and op.get('op') == 'add'}
+    if adds and user.get('is_admin'):
+        raise ApiError('Admins cannot add to cart.', status=403)
+
+    # every product referenced by an add is fetched in one query
+    product_ids = {op_int(op, 'product_id', position) for position, op in adds.items()}
+    products = {p.id: p for p in Product.query.filter(Product.id.in_(product_ids))} if product_ids else {}
+
+    # ops apply in order against a copy; nothing is saved unless all succeed
+    cart_items = [dict(item) for item in get_cart()]
+    for position, op in enumerate(ops):
+        if not isinstance(op, dict):
+            raise ApiError(f'ops[{position}] must be an object.')
+        kind = op.get('op')
+        if kind == 'add':
+            product_id = op_int(op, 'product_id', position)
+            product = products.get(product_id)
+            if product is None:
+                raise ApiError(f'ops[{position}]: product {product_id} not found.', status=404)
+            quantity = op_int(op, 'quantity', position, default=1)
+            if quantity < 1:
+                raise ApiError(f'ops[{position}]: quantity must be at least 1.')
+            cart_items.append(make_cart_line(product, quantity, op.get('variant', '')))
+        elif kind in ('update', 'remove'):
+            index = op_int(op, 'index', position)
+            if not 0 <= index < len(cart_items):
+                raise ApiError(f'ops[{position}]: index {index} is out of range.')
+            if kind == 'remove':
+                cart_items.pop(index)
+            else:
+                quantity = op_int(op, 'quantity', position)
+                if quantity < 1:
+                    raise ApiError(f'ops[{position}]: quantity must be at least 1.')
+                item = cart_items[index]
+                item['quantity'] = quantity
+                item['line_total'] = item['unit_price'] * quantity
+        elif kind == 'clear':
+            cart_items = []
+        else:
+            raise ApiError(f'ops[{position}]: unknown op {kind!r}.')
+
+    save_cart(cart_items)
+    return api_response(cart_payload(cart_items))
+
+
 if __name__ == '__main__':
     # for local development
     app.run(debug=True)